@@ -1,127 +1,127 @@
 import streamlit as st
 import os
+import asyncio
 import logging
 import threading
-import time
 from dotenv import load_dotenv
-from slack_bolt import App
-from slack_bolt.adapter.socket_mode import SocketModeHandler
-from supabase import create_client, Client
-import io
-import sys
+import orjson
+from collections import deque
+from itertools import islice
+import bot_core
+from bot_core import DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL_S
 
 # --- Initial Configuration ---
 load_dotenv() # Load .env file if present, UI will override
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+if not logging.getLogger().handlers: # Streamlit re-executes this module on every rerun
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
 
+# Environment variables that pre-fill the configuration form, with their fallbacks
+ENV_DEFAULTS = {
+    "SLACK_BOT_TOKEN": "",
+    "SLACK_APP_TOKEN": "",
+    "SUPABASE_URL": "",
+    "SUPABASE_SERVICE_KEY": "",
+    "TARGET_SLACK_USER_ID": "",
+    "SUPABASE_TABLE_NAME": "slack_messages_for_sensay",
+    "SUPABASE_DB_URL": "",
+    "BATCH_SIZE": DEFAULT_BATCH_SIZE,
+    "FLUSH_INTERVAL_S": DEFAULT_FLUSH_INTERVAL_S,
+}
+
+# st.number_input raises if its value is below min_value, so environment values that are
+# not numbers or are out of range fall back to the default instead of breaking the page
+def number_env_default(value, cast, fallback, min_value):
+    try:
+        number = cast(value)
+    except (TypeError, ValueError):
+        return fallback
+    return number if number >= min_value else fallback
+
+LOG_REFRESH_INTERVAL_S = 2 # How often the log panel polls for new lines while the bot runs
+LOG_TAIL_LINES = 200 # Lines shown in the log panel, newest first; the full buffer is available as a download
+
 # --- Streamlit Log Capture ---
-# This class will capture stdout and stderr to be displayed in Streamlit
-class StreamlitLogHandler(io.StringIO):
+# This class holds the bot's log lines to be displayed in Streamlit.
+# It is fed by StreamlitLoggingHandler rather than by redirecting sys.stdout/sys.stderr,
+# which are process-global and would also capture the Streamlit thread's output.
+class StreamlitLogHandler:
+    MAX_LOG_LINES = 2000 # Only the most recent lines are kept in memory
+
     def __init__(self):
-        super().__init__()
-        self.buffer = [] # Store log messages
+        self.buffer = deque(maxlen=self.MAX_LOG_LINES) # Store log messages
+        self._version = 0 # Incremented on every write
+        self._cached_str = None # Joined logs, rebuilt only after new writes
+        self._cached_version = -1
+        self._cached_tail = None # Last LOG_TAIL_LINES writes, newest first, cached the same way
+        self._cached_tail_version = -1
+        # The bot thread writes while the Streamlit thread reads
+        self._lock = threading.Lock()
 
     def write(self, message):
         # Add message to internal buffer
-        self.buffer.append(message)
-        # Also write to actual stdout/stderr for console logging
-        sys.__stdout__.write(message) # Or sys.__stderr__
+        with self._lock:
+            self.buffer.append(message)
+            self._version += 1
 
     def get_logs(self):
-        return "".join(self.buffer)
+        with self._lock:
+            if self._cached_version != self._version:
+                self._cached_str = "".join(self.buffer)
+                self._cached_version = self._version
+            return self._cached_str
+
+    def get_log_tail(self, lines=LOG_TAIL_LINES):
+        with self._lock:
+            if self._cached_tail_version != self._version:
+                # Newest entries first so the latest lines are visible without scrolling.
+                # Each entry is one whole record, so multi-line tracebacks keep their order.
+                self._cached_tail = "".join(islice(reversed(self.buffer), lines))
+                self._cached_tail_version = self._version
+            return self._cached_tail
 
     def clear_logs(self):
-        self.buffer = []
-        self.truncate(0)
-        self.seek(0)
+        with self._lock:
+            self.buffer.clear()
+            self._version += 1
+
+# Forwards formatted log records into a StreamlitLogHandler buffer.
+# The loggers it is attached to are process-global, so it only accepts records emitted
+# by its own bot thread; otherwise every session's UI would show every other session's bot logs.
+class StreamlitLoggingHandler(logging.Handler):
+    def __init__(self, log_capture_buffer, thread_ident):
+        super().__init__()
+        self.buf = log_capture_buffer
+        self.addFilter(lambda record: record.thread == thread_ident)
+
+    def emit(self, record):
+        try:
+            self.buf.write(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
 
 # --- Bot Logic (Encapsulated in a function) ---
 def start_slack_bot_listener(config, stop_event, log_capture_buffer):
-    slack_bot_token = config["SLACK_BOT_TOKEN"]
-    slack_app_token = config["SLACK_APP_TOKEN"]
-    supabase_url = config["SUPABASE_URL"]
-    supabase_service_key = config["SUPABASE_SERVICE_KEY"]
-    target_slack_user_id = config["TARGET_SLACK_USER_ID"]
-    supabase_table_name = config.get("SUPABASE_TABLE_NAME", "slack_messages_for_sensay")
-
-    # Redirect stdout and stderr for this thread
-    original_stdout = sys.stdout
-    original_stderr = sys.stderr
-    sys.stdout = log_capture_buffer
-    sys.stderr = log_capture_buffer
+    # Route the bot's log records into the UI buffer as well as the console
+    ui_log_handler = StreamlitLoggingHandler(log_capture_buffer, threading.get_ident())
+    ui_log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    bot_loggers = (logger, bot_core.logger)
+    for bot_logger in bot_loggers:
+        bot_logger.addHandler(ui_log_handler)
 
     logger.info("Bot thread started. Initializing Slack and Supabase clients...")
-    log_capture_buffer.write("Bot thread started. Initializing Slack and Supabase clients...\n")
 
+    # The bot runs on its own event loop inside this thread; asyncio.run also cancels leftover
+    # tasks and shuts down async generators and the default executor before closing the loop
     try:
-        bot_app = App(token=slack_bot_token)
-        supabase: Client = create_client(supabase_url, supabase_service_key)
-
-        logger.info(f"Supabase client initialized for URL: {supabase_url}")
-        logger.info(f"Monitoring messages from Slack User ID: {target_slack_user_id}")
-        logger.info(f"Storing messages in Supabase table: {supabase_table_name}")
-        log_capture_buffer.write(f"Supabase client initialized for URL: {supabase_url}\n")
-        log_capture_buffer.write(f"Monitoring messages from Slack User ID: {target_slack_user_id}\n")
-        log_capture_buffer.write(f"Storing messages in Supabase table: {supabase_table_name}\n")
-
-
-        @bot_app.event("message")
-        def handle_message_events(event, say):
-            event_user_id = event.get("user")
-            message_text = event.get("text")
-            channel_id = event.get("channel")
-            message_ts = event.get("ts")
-
-            if event.get("subtype") is None and event_user_id == target_slack_user_id and message_text:
-                log_msg = f"Received message from target user ({event_user_id}) in channel ({channel_id}): '{message_text[:50]}...'"
-                logger.info(log_msg)
-                log_capture_buffer.write(log_msg + "\n")
-
-                try:
-                    data_to_insert = {
-                        "slack_user_id": event_user_id,
-                        "slack_channel_id": channel_id,
-                        "message_content": message_text,
-                        "slack_message_ts": message_ts
-                    }
-                    response = supabase.table(supabase_table_name).insert(data_to_insert).execute()
-
-                    if response.data:
-                        log_msg = f"Message successfully stored in Supabase. ID: {response.data[0]['id']}"
-                        logger.info(log_msg)
-                        log_capture_buffer.write(log_msg + "\n")
-                    else:
-                        err_msg = f"Supabase insert did not return data: {response.error if response.error else 'No error info'}"
-                        logger.warning(err_msg)
-                        log_capture_buffer.write(f"WARNING: {err_msg}\n")
-                        if response.error and "violates unique constraint" in str(response.error.message).lower():
-                            logger.warning(f"Duplicate message (slack_message_ts: {message_ts}) not inserted.")
-                            log_capture_buffer.write(f"WARNING: Duplicate message (slack_message_ts: {message_ts}) not inserted.\n")
-
-                except Exception as e:
-                    err_msg = f"Error storing message in Supabase: {e}"
-                    logger.error(err_msg)
-                    log_capture_buffer.write(f"ERROR: {err_msg}\n")
-
-        logger.info("Starting SocketModeHandler...")
-        log_capture_buffer.write("Starting SocketModeHandler...\n")
-        handler = SocketModeHandler(bot_app, slack_app_token)
-        
-        # Start the handler. This is blocking.
-        # The thread will keep running this until the handler stops or an error occurs.
-        # The stop_event is not directly used by handler.start() here.
-        handler.start() 
-
+        asyncio.run(bot_core.collect_messages(config, stop_event))
     except Exception as e:
-        err_msg = f"Critical error in bot thread: {e}"
-        logger.error(err_msg, exc_info=True)
-        log_capture_buffer.write(f"CRITICAL ERROR: {err_msg}\n")
+        logger.error("Critical error in bot thread: %s", e, exc_info=True)
     finally:
-        logger.info("Bot thread attempting to clean up and exit.")
-        log_capture_buffer.write("Bot thread attempting to clean up and exit.\n")
-        sys.stdout = original_stdout # Restore original stdout
-        sys.stderr = original_stderr # Restore original stderr
+        logger.info("Bot thread cleaned up and is exiting.")
+        for bot_logger in bot_loggers:
+            bot_logger.removeHandler(ui_log_handler)
 
 
 # --- Streamlit UI ---
@@ -137,10 +137,13 @@ if 'bot_started' not in st.session_state:
 if 'bot_thread' not in st.session_state:
     st.session_state.bot_thread = None
 if 'stop_event' not in st.session_state:
-    # stop_event is used to signal the thread, though SocketModeHandler().start() doesn't use it directly for stopping
+    # stop_event tells the bot to close its Slack connection, flush queued messages and exit
     st.session_state.stop_event = threading.Event() 
 if 'streamlit_log_handler' not in st.session_state:
     st.session_state.streamlit_log_handler = StreamlitLogHandler()
+if 'env_defaults' not in st.session_state:
+    # Read the environment once per session instead of on every rerun
+    st.session_state.env_defaults = {key: os.getenv(key, default) for key, default in ENV_DEFAULTS.items()}
 
 
 # --- Configuration Input Area ---
@@ -148,13 +151,17 @@ if not st.session_state.env_vars_confirmed:
     st.subheader("Step 1: Configure Environment Variables")
     with st.form("env_var_form"):
         st.markdown("These values will be used to run the Slack bot. They are stored in session state and not persisted beyond your browser session unless you use a .env file as a fallback.")
+        env_defaults = st.session_state.env_defaults
         
-        slack_bot_token = st.text_input("Slack Bot Token (xoxb-)", value=os.getenv("SLACK_BOT_TOKEN", ""), type="password")
-        slack_app_token = st.text_input("Slack App Token (xapp-)", value=os.getenv("SLACK_APP_TOKEN", ""), type="password")
-        supabase_url = st.text_input("Supabase Project URL", value=os.getenv("SUPABASE_URL", ""))
-        supabase_service_key = st.text_input("Supabase Service Role Key", value=os.getenv("SUPABASE_SERVICE_KEY", ""), type="password")
-        target_slack_user_id = st.text_input("Target Slack User ID (e.g., UXXXXXXXXXX)", value=os.getenv("TARGET_SLACK_USER_ID", ""))
-        supabase_table_name = st.text_input("Supabase Table Name", value=os.getenv("SUPABASE_TABLE_NAME", "slack_messages_for_sensay"))
+        slack_bot_token = st.text_input("Slack Bot Token (xoxb-)", value=env_defaults["SLACK_BOT_TOKEN"], type="password")
+        slack_app_token = st.text_input("Slack App Token (xapp-)", value=env_defaults["SLACK_APP_TOKEN"], type="password")
+        supabase_url = st.text_input("Supabase Project URL", value=env_defaults["SUPABASE_URL"])
+        supabase_service_key = st.text_input("Supabase Service Role Key", value=env_defaults["SUPABASE_SERVICE_KEY"], type="password")
+        target_slack_user_id = st.text_input("Target Slack User ID (e.g., UXXXXXXXXXX)", value=env_defaults["TARGET_SLACK_USER_ID"])
+        supabase_table_name = st.text_input("Supabase Table Name", value=env_defaults["SUPABASE_TABLE_NAME"])
+        supabase_db_url = st.text_input("Supabase Database Connection String (optional, enables COPY inserts)", value=env_defaults["SUPABASE_DB_URL"], type="password")
+        batch_size = st.number_input("Insert Batch Size (rows)", min_value=1, value=number_env_default(env_defaults["BATCH_SIZE"], int, DEFAULT_BATCH_SIZE, 1))
+        flush_interval_s = st.number_input("Flush Interval (seconds)", min_value=0.1, value=number_env_default(env_defaults["FLUSH_INTERVAL_S"], float, DEFAULT_FLUSH_INTERVAL_S, 0.1))
 
         submitted = st.form_submit_button("Save Configuration")
 
@@ -178,7 +185,22 @@ if not st.session_state.env_vars_confirmed:
                     "SUPABASE_URL": supabase_url,
                     "SUPABASE_SERVICE_KEY": supabase_service_key,
                     "TARGET_SLACK_USER_ID": target_slack_user_id,
-                    "SUPABASE_TABLE_NAME": supabase_table_name or "slack_messages_for_sensay"
+                    "SUPABASE_TABLE_NAME": supabase_table_name or "slack_messages_for_sensay",
+                    "SUPABASE_DB_URL": supabase_db_url,
+                    "BATCH_SIZE": int(batch_size),
+                    "FLUSH_INTERVAL_S": float(flush_interval_s)
+                }
+                # Masked copy for the "Current Configuration" panel, built once instead of on every rerun
+                st.session_state.config_display = {
+                    "SLACK_BOT_TOKEN": f"{slack_bot_token[:5]}...",
+                    "SLACK_APP_TOKEN": f"{slack_app_token[:5]}...",
+                    "SUPABASE_URL": supabase_url,
+                    "SUPABASE_SERVICE_KEY": f"{supabase_service_key[:5]}...",
+                    "TARGET_SLACK_USER_ID": target_slack_user_id,
+                    "SUPABASE_TABLE_NAME": st.session_state.config["SUPABASE_TABLE_NAME"],
+                    "SUPABASE_DB_URL": "Set" if supabase_db_url else "Not Set",
+                    "BATCH_SIZE": int(batch_size),
+                    "FLUSH_INTERVAL_S": float(flush_interval_s)
                 }
                 st.session_state.env_vars_confirmed = True
                 st.success("Configuration saved! You can now start the bot.")
@@ -190,17 +212,7 @@ else:
     col1, col2 = st.columns(2)
     with col1:
         st.write("Current Configuration (Secrets are masked):")
-        config_display = {}
-        if 'config' in st.session_state:
-            config_display = {
-                "SLACK_BOT_TOKEN": f"{st.session_state.config.get('SLACK_BOT_TOKEN', '')[:5]}..." if st.session_state.config.get('SLACK_BOT_TOKEN') else "Not Set",
-                "SLACK_APP_TOKEN": f"{st.session_state.config.get('SLACK_APP_TOKEN', '')[:5]}..." if st.session_state.config.get('SLACK_APP_TOKEN') else "Not Set",
-                "SUPABASE_URL": st.session_state.config.get('SUPABASE_URL', 'Not Set'),
-                "SUPABASE_SERVICE_KEY": f"{st.session_state.config.get('SUPABASE_SERVICE_KEY', '')[:5]}..." if st.session_state.config.get('SUPABASE_SERVICE_KEY') else "Not Set",
-                "TARGET_SLACK_USER_ID": st.session_state.config.get('TARGET_SLACK_USER_ID', 'Not Set'),
-                "SUPABASE_TABLE_NAME": st.session_state.config.get('SUPABASE_TABLE_NAME', 'Not Set')
-            }
-        st.json(config_display)
+        st.code(orjson.dumps(st.session_state.get('config_display', {}), option=orjson.OPT_INDENT_2).decode(), language="json")
 
     with col2:
         if not st.session_state.bot_started:
@@ -208,68 +220,74 @@ else:
                 if st.session_state.bot_thread is None or not st.session_state.bot_thread.is_alive():
                     st.session_state.streamlit_log_handler.clear_logs() # Clear previous logs
                     st.session_state.stop_event.clear() # Ensure stop event is clear before starting
+                    # Not a daemon thread: on shutdown the interpreter marks the main thread stopped
+                    # and then joins this thread, so the bot sees that, closes Slack and flushes queued rows.
+                    # (A ThreadPoolExecutor worker is joined before the main thread is marked stopped,
+                    # so it would never exit.)
                     st.session_state.bot_thread = threading.Thread(
                         target=start_slack_bot_listener,
                         args=(st.session_state.config, st.session_state.stop_event, st.session_state.streamlit_log_handler),
-                        daemon=True 
+                        name="slack-bot"
                     )
                     st.session_state.bot_thread.start()
                     st.session_state.bot_started = True
                     st.info("Bot listener thread started. Check logs below.")
                     st.rerun() # Rerun to update log display loop
                 else:
-                    st.warning("Bot thread seems to be already running.")
+                    st.warning("Bot thread is still shutting down. Try again in a moment.")
         else:
             st.success("Bot listener is active (in a background thread).")
-            if st.button("Reset Configuration (Stops UI indication, thread may continue)", key="stop_bot"):
-                if st.session_state.stop_event:
-                    st.session_state.stop_event.set() # Signal thread (though it might not be checked by the handler)
-                
-                # Give the thread a moment to potentially react if it were designed to
-                # time.sleep(0.1) 
+            if st.button("Stop Bot and Reset Configuration", key="stop_bot"):
+                st.session_state.stop_event.set() # The bot disconnects, flushes queued messages and exits
 
                 st.session_state.bot_started = False
                 st.session_state.env_vars_confirmed = False
-                # Don't nullify bot_thread immediately if you want to check its status later
-                # st.session_state.bot_thread = None 
+                # Keep bot_thread so a new start waits for this run to finish shutting down
                 st.session_state.streamlit_log_handler.write("UI Stop requested. Resetting configuration.\n")
-                st.warning("UI indication stopped. Bot thread may continue running in the background until the Streamlit app is fully closed.")
+                st.warning("Stop requested. The bot will disconnect from Slack once queued messages are stored.")
                 st.rerun()
 
     st.subheader("Bot Logs")
-    log_placeholder = st.empty()
 
-    log_display_label = "Logs"
-    log_display_content = "Bot not started or no logs yet."
-    show_rerun_trigger_for_logs = False
-
-    if st.session_state.bot_started:
-        log_display_label = "Logs (Bot Active)"
-        log_display_content = st.session_state.streamlit_log_handler.get_logs()
-        
-        if st.session_state.bot_thread and st.session_state.bot_thread.is_alive():
-            show_rerun_trigger_for_logs = True
-        elif st.session_state.bot_thread and not st.session_state.bot_thread.is_alive():
-            st.warning("Bot thread appears to have stopped unexpectedly. Displaying last known logs.")
-    
-    elif 'streamlit_log_handler' in st.session_state and st.session_state.streamlit_log_handler.get_logs():
-        log_display_label = "Logs (Bot Inactive)"
-        log_display_content = st.session_state.streamlit_log_handler.get_logs()
-
-    log_placeholder.text_area(
-        log_display_label,
-        value=log_display_content,
-        height=300,
-        key="bot_log_text_area_main_display",
-        disabled=True
-    )
-
-    if show_rerun_trigger_for_logs:
-        try:
-            time.sleep(2) 
-            st.rerun()
-        except Exception as e:
-            logger.warning(f"Exception during st.rerun for log update: {e}")
+    bot_thread_alive = st.session_state.bot_thread is not None and st.session_state.bot_thread.is_alive()
+
+    # Only this fragment is rerun on the refresh interval, not the whole script
+    @st.fragment(run_every=LOG_REFRESH_INTERVAL_S if st.session_state.bot_started and bot_thread_alive else None)
+    def render_bot_logs():
+        log_handler = st.session_state.streamlit_log_handler
+        log_display_label = "Logs"
+        log_display_content = "Bot not started or no logs yet."
+
+        if st.session_state.bot_started:
+            log_display_label = "Logs (Bot Active)"
+            log_display_content = log_handler.get_log_tail()
+
+            if st.session_state.bot_thread and not st.session_state.bot_thread.is_alive():
+                if bot_thread_alive:
+                    st.rerun() # Thread stopped since the last full run; rerun the app to stop polling
+                st.warning("Bot thread appears to have stopped unexpectedly. Displaying last known logs.")
+
+        elif log_handler.get_log_tail():
+            log_display_label = "Logs (Bot Inactive)"
+            log_display_content = log_handler.get_log_tail()
+
+        # Only the most recent lines are sent to the browser on each refresh
+        st.caption(f"{log_display_label} - last {LOG_TAIL_LINES} lines, newest first")
+        with st.container(height=300):
+            st.code(log_display_content, language="log")
+
+    render_bot_logs()
+
+    # Kept outside the auto-refreshing fragment: the full buffer is only joined and
+    # handed to Streamlit when the user asks for it, not on every log refresh.
+    if st.button("Prepare full log download", key="prepare_bot_log_download"):
+        st.download_button(
+            "Download full log",
+            data=st.session_state.streamlit_log_handler.get_logs(),
+            file_name="deshi_bot.log",
+            mime="text/plain",
+            key="download_bot_logs"
+        )
 
 
 st.markdown("---")
@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import threading
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.adapter.socket_mode.aiohttp import AsyncSocketModeHandler
+from supabase import acreate_client, AsyncClient
+from postgrest.exceptions import APIError
+import asyncpg
+import orjson
+from collections import OrderedDict, deque, namedtuple
+
+# Shared bot logic used by both app.py (Streamlit UI) and console_bot.py (console)
+logger = logging.getLogger(__name__)
+
+# Rows are queued and written to Supabase in batches instead of one request per message.
+# A batch is flushed once it reaches BATCH_SIZE rows or after FLUSH_INTERVAL_S seconds.
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_FLUSH_INTERVAL_S = 2.0
+MAX_IN_FLIGHT_INSERTS = 16 # Caps concurrent insert requests to Supabase
+UNIQUE_VIOLATION = "23505" # Postgres error code for a unique constraint violation
+MAX_SEEN_MESSAGE_TS = 10_000 # Recently seen Slack message timestamps kept for client-side deduplication
+STOP_POLL_INTERVAL_S = 0.5 # How often the bot checks whether it has been asked to stop
+# Queued rows are plain tuples in column order, so COPY can take them as-is
+MESSAGE_COLUMNS = ["slack_user_id", "slack_channel_id", "message_content", "slack_message_ts"]
+MessageRow = namedtuple("MessageRow", MESSAGE_COLUMNS)
+# Headers for bulk inserts posted directly to PostgREST with a pre-encoded body
+REST_INSERT_HEADERS = {"Content-Type": "application/json", "Prefer": "return=minimal"}
+
+
+def read_batch_settings(config):
+    # Validated up front: a batch size below 1 never drains the queue, and a
+    # non-positive flush interval turns the periodic flush into a busy loop
+    try:
+        batch_size = int(config.get("BATCH_SIZE", DEFAULT_BATCH_SIZE))
+        flush_interval_s = float(config.get("FLUSH_INTERVAL_S", DEFAULT_FLUSH_INTERVAL_S))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"BATCH_SIZE and FLUSH_INTERVAL_S must be numbers: {e}") from e
+    if batch_size < 1:
+        raise ValueError(f"BATCH_SIZE must be at least 1, got {batch_size}")
+    if not flush_interval_s > 0:
+        raise ValueError(f"FLUSH_INTERVAL_S must be greater than 0, got {flush_interval_s}")
+    return batch_size, flush_interval_s
+
+
+def build_target_matcher(target_slack_user_id):
+    async def is_target_message(event):
+        # Evaluated by Bolt before the listener runs, so other users' messages never reach the handler
+        return event.get("subtype") is None and event.get("user") == target_slack_user_id and bool(event.get("text"))
+
+    return is_target_message
+
+
+# seen_message_ts is an LRU (OrderedDict) of recently queued slack_message_ts values. It is only
+# touched from the event loop, so no lock is needed.
+def build_message_handler(target_slack_user_id, enqueue_row, seen_message_ts):
+    async def handle_message_events(event, say):
+        message_text = event["text"]
+        channel_id = event.get("channel")
+        message_ts = event.get("ts")
+
+        if message_ts in seen_message_ts:
+            seen_message_ts.move_to_end(message_ts)
+            logger.info("Duplicate message (slack_message_ts: %s) already received, skipping.", message_ts)
+            return
+        seen_message_ts[message_ts] = None
+        if len(seen_message_ts) > MAX_SEEN_MESSAGE_TS:
+            seen_message_ts.popitem(last=False)
+
+        logger.info("Received message from target user (%s) in channel (%s): '%.70s...'", target_slack_user_id, channel_id, message_text)
+        enqueue_row(MessageRow(target_slack_user_id, channel_id, message_text, message_ts))
+
+    return handle_message_events
+
+
+async def ignore_other_messages():
+    pass # Acknowledges non-target messages so Bolt does not log them as unhandled
+
+
+def register_handlers(bot_app, target_slack_user_id, enqueue_row, seen_message_ts):
+    bot_app.event("message", matchers=[build_target_matcher(target_slack_user_id)])(
+        build_message_handler(target_slack_user_id, enqueue_row, seen_message_ts)
+    )
+    bot_app.event("message")(ignore_other_messages)
+
+
+# Runs the bot until stop_event is set (if given) or the interpreter starts shutting down.
+# Shutdown is detected through threading.main_thread().is_alive(), which only turns False before
+# plain non-daemon threads are joined; run this on such a thread (or the main thread), not on a
+# ThreadPoolExecutor worker, whose exit hook joins it while the main thread still looks alive.
+async def collect_messages(config, stop_event=None):
+    slack_bot_token = config["SLACK_BOT_TOKEN"]
+    slack_app_token = config["SLACK_APP_TOKEN"]
+    supabase_url = config["SUPABASE_URL"]
+    supabase_service_key = config["SUPABASE_SERVICE_KEY"]
+    target_slack_user_id = config["TARGET_SLACK_USER_ID"]
+    supabase_table_name = config.get("SUPABASE_TABLE_NAME", "slack_messages_for_sensay")
+    supabase_db_url = config.get("SUPABASE_DB_URL") # Optional direct Postgres connection string
+    batch_size, flush_interval_s = read_batch_settings(config)
+
+    pending_rows = deque() # Rows waiting to be flushed to Supabase
+    seen_message_ts = OrderedDict() # Shared with the message handler for client-side deduplication
+    in_flight_inserts = set()
+    flush_task = None
+    db_pool = None
+    socket_handler = None
+
+    try:
+        bot_app = AsyncApp(token=slack_bot_token)
+        supabase: AsyncClient = await acreate_client(supabase_url, supabase_service_key)
+        messages_table = supabase.table(supabase_table_name) # Built once; each insert() returns a fresh query
+        insert_slots = asyncio.Semaphore(MAX_IN_FLIGHT_INSERTS)
+        if supabase_db_url:
+            # Batches go straight to Postgres with COPY; the REST API is kept for row-by-row retries
+            # statement_cache_size=0 keeps it compatible with Supabase's transaction-mode pooler
+            db_pool = await asyncpg.create_pool(supabase_db_url, min_size=1, max_size=4, statement_cache_size=0)
+
+        logger.info("Supabase client initialized for URL: %s", supabase_url)
+        logger.info("Monitoring messages from Slack User ID: %s", target_slack_user_id)
+        logger.info("Storing messages in Supabase table: %s", supabase_table_name)
+        logger.info("Batching inserts: up to %s rows every %ss", batch_size, flush_interval_s)
+        logger.info("Batch insert path: %s", "Postgres COPY" if db_pool is not None else "Supabase REST API")
+
+        async def insert_rows_individually(rows):
+            # A bulk insert is atomic, so one duplicate rejects the whole batch.
+            # Retry row by row so only the duplicates are dropped.
+            for row in rows:
+                try:
+                    await messages_table.insert(row._asdict(), returning="minimal").execute()
+                except APIError as e:
+                    if e.code == UNIQUE_VIOLATION:
+                        logger.warning("Duplicate message (slack_message_ts: %s) not inserted.", row.slack_message_ts)
+                    else:
+                        logger.error("Error storing message in Supabase: %s", e, exc_info=True)
+                        # Forget the failed row so a redelivery from Slack is not skipped as a duplicate
+                        seen_message_ts.pop(row.slack_message_ts, None)
+                except Exception as e:
+                    logger.error("Error storing message in Supabase: %s", e, exc_info=True)
+                    seen_message_ts.pop(row.slack_message_ts, None)
+
+        async def copy_rows(rows):
+            try:
+                async with db_pool.acquire() as connection:
+                    await connection.copy_records_to_table(
+                        supabase_table_name,
+                        records=rows,
+                        columns=MESSAGE_COLUMNS
+                    )
+                logger.info("%s message(s) successfully stored in Supabase.", len(rows))
+            except asyncpg.UniqueViolationError:
+                logger.warning("Batch of %s message(s) contains a duplicate. Retrying row by row.", len(rows))
+                await insert_rows_individually(rows)
+            except Exception as e:
+                # Any other failure would lose the whole batch; fall back to the REST API one row at a time
+                logger.error("Error storing %s message(s) in Supabase: %s. Retrying row by row.", len(rows), e, exc_info=True)
+                await insert_rows_individually(rows)
+
+        rest_insert_path = f"/{supabase_table_name}"
+
+        async def post_rows(rows):
+            # Encodes the whole batch in one orjson call and posts it straight to PostgREST,
+            # skipping supabase-py's per-request JSON encoding
+            payload = orjson.dumps([row._asdict() for row in rows])
+            response = await supabase.postgrest.session.post(rest_insert_path, content=payload, headers=REST_INSERT_HEADERS)
+            if response.is_error:
+                try:
+                    error = response.json()
+                except ValueError:
+                    error = {"message": response.text, "code": str(response.status_code)}
+                raise APIError(error)
+
+        async def insert_rows(rows):
+            async with insert_slots:
+                if db_pool is not None:
+                    await copy_rows(rows)
+                    return
+                try:
+                    await post_rows(rows)
+                    logger.info("%s message(s) successfully stored in Supabase.", len(rows))
+                except APIError as e:
+                    if e.code == UNIQUE_VIOLATION:
+                        logger.warning("Batch of %s message(s) contains a duplicate. Retrying row by row.", len(rows))
+                    else:
+                        logger.error("Error storing %s message(s) in Supabase: %s. Retrying row by row.", len(rows), e, exc_info=True)
+                    await insert_rows_individually(rows)
+                except Exception as e:
+                    # A transient network failure would otherwise lose the whole batch
+                    logger.error("Error storing %s message(s) in Supabase: %s. Retrying row by row.", len(rows), e, exc_info=True)
+                    await insert_rows_individually(rows)
+
+        def flush_pending_rows():
+            # Each batch becomes its own insert task so writes overlap with event handling
+            while pending_rows:
+                rows = []
+                while pending_rows and len(rows) < batch_size:
+                    rows.append(pending_rows.popleft())
+                task = asyncio.create_task(insert_rows(rows))
+                in_flight_inserts.add(task)
+                task.add_done_callback(in_flight_inserts.discard)
+
+        async def flush_pending_rows_periodically():
+            while True:
+                await asyncio.sleep(flush_interval_s)
+                flush_pending_rows()
+
+        def enqueue_row(row):
+            pending_rows.append(row)
+            if len(pending_rows) >= batch_size:
+                flush_pending_rows()
+
+        flush_task = asyncio.create_task(flush_pending_rows_periodically())
+        register_handlers(bot_app, target_slack_user_id, enqueue_row, seen_message_ts)
+
+        socket_handler = AsyncSocketModeHandler(bot_app, slack_app_token)
+        logger.info("Connecting to Slack via Socket Mode...")
+        await socket_handler.connect_async()
+
+        # Keep the connection open until stop_event is set or the process is shutting down.
+        # The handler is closed from this loop, since its aiohttp session is not thread-safe.
+        while not (stop_event is not None and stop_event.is_set()) and threading.main_thread().is_alive():
+            await asyncio.sleep(STOP_POLL_INTERVAL_S)
+        logger.info("Stop requested. Closing the Slack connection...")
+
+    finally:
+        if socket_handler is not None:
+            # A failed close must not skip the final flush below
+            try:
+                await socket_handler.close_async()
+            except Exception as e:
+                logger.error("Error closing the Slack connection: %s", e, exc_info=True)
+        if flush_task is not None:
+            flush_task.cancel()
+            # Final flush of anything still queued, waiting for in-flight inserts
+            flush_pending_rows()
+            await asyncio.gather(*in_flight_inserts)
+        if db_pool is not None:
+            await db_pool.close()
@@ -1,10 +1,11 @@
 import os
+import asyncio
 import logging
 from dotenv import load_dotenv
-from slack_bolt import App
-from slack_bolt.adapter.socket_mode import SocketModeHandler
-from supabase import create_client, Client
 import sys
+from bot_core import DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL_S, collect_messages
+
+logger = logging.getLogger(__name__)
 
 def get_env_variable(var_name, prompt_text, is_secret=False):
     value = os.getenv(var_name)
@@ -15,14 +16,14 @@ def get_env_variable(var_name, prompt_text, is_secret=False):
         else:
             value = input(f"{prompt_text}: ")
         if not value:
-            logging.error(f"Required configuration '{var_name}' was not provided. Exiting.")
+            logging.error("Required configuration '%s' was not provided. Exiting.", var_name)
             sys.exit(1)
     return value
 
 def run_bot():
     load_dotenv()
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    logger = logging.getLogger(__name__)
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
     slack_bot_token = get_env_variable("SLACK_BOT_TOKEN", "Enter Slack Bot Token (xoxb-)", is_secret=True)
     slack_app_token = get_env_variable("SLACK_APP_TOKEN", "Enter Slack App Token (xapp-)", is_secret=True)
@@ -32,51 +33,29 @@ def run_bot():
     supabase_table_name = os.getenv("SUPABASE_TABLE_NAME")
     if not supabase_table_name:
         supabase_table_name = input("Enter Supabase Table Name (default: slack_messages_for_sensay): ") or "slack_messages_for_sensay"
+    supabase_db_url = os.getenv("SUPABASE_DB_URL") # Optional direct Postgres connection string
+    # Parsed and validated by collect_messages, so a bad value is reported like any other startup error
+    batch_size = os.getenv("BATCH_SIZE", DEFAULT_BATCH_SIZE)
+    flush_interval_s = os.getenv("FLUSH_INTERVAL_S", DEFAULT_FLUSH_INTERVAL_S)
 
     logger.info("Initializing Deshi Knowledge Collector Bot...")
 
-    try:
-        slack_app = App(token=slack_bot_token)
-        supabase_client: Client = create_client(supabase_url, supabase_service_key)
-
-        logger.info(f"Supabase client initialized for URL: {supabase_url}")
-        logger.info(f"Monitoring messages from Slack User ID: {target_slack_user_id}")
-        logger.info(f"Storing messages in Supabase table: {supabase_table_name}")
-
-        @slack_app.event("message")
-        def handle_message_events(event, say):
-            event_user_id = event.get("user")
-            message_text = event.get("text")
-            channel_id = event.get("channel")
-            message_ts = event.get("ts")
-
-            if event.get("subtype") is None and event_user_id == target_slack_user_id and message_text:
-                logger.info(f"Received message from target user ({event_user_id}) in channel ({channel_id}): '{message_text[:70]}...'")
-                try:
-                    data_to_insert = {
-                        "slack_user_id": event_user_id,
-                        "slack_channel_id": channel_id,
-                        "message_content": message_text,
-                        "slack_message_ts": message_ts
-                    }
-                    response = supabase_client.table(supabase_table_name).insert(data_to_insert).execute()
-                    if response.data:
-                        logger.info(f"Message successfully stored in Supabase. ID: {response.data[0]['id']}")
-                    else:
-                        logger.warning(f"Supabase insert did not return data: {response.error if response.error else 'No error info'}")
-                        if response.error and "violates unique constraint" in str(response.error.message).lower():
-                             logger.warning(f"Duplicate message (slack_message_ts: {message_ts}) not inserted.")
-                        elif response.error:
-                             logger.error(f"Failed to store message in Supabase: {response.error}")
-                except Exception as e_db:
-                    logger.error(f"Error storing message in Supabase: {e_db}", exc_info=True)
-
-        socket_handler = SocketModeHandler(slack_app, slack_app_token)
-        logger.info("Connecting to Slack via Socket Mode...")
-        socket_handler.start()
+    config = {
+        "SLACK_BOT_TOKEN": slack_bot_token,
+        "SLACK_APP_TOKEN": slack_app_token,
+        "SUPABASE_URL": supabase_url,
+        "SUPABASE_SERVICE_KEY": supabase_service_key,
+        "TARGET_SLACK_USER_ID": target_slack_user_id,
+        "SUPABASE_TABLE_NAME": supabase_table_name,
+        "SUPABASE_DB_URL": supabase_db_url,
+        "BATCH_SIZE": batch_size,
+        "FLUSH_INTERVAL_S": flush_interval_s
+    }
 
+    try:
+        asyncio.run(collect_messages(config))
     except Exception as e_main:
-        logger.critical(f"A critical error occurred: {e_main}", exc_info=True)
+        logger.critical("A critical error occurred: %s", e_main, exc_info=True)
     finally:
         logger.info("Bot has shut down or encountered a critical error.")
 